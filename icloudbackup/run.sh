@@ -11,10 +11,14 @@ USERNAME=$(bashio::config "username")
 PASSWORD=$(bashio::config "password")
 DIRECTORY=$(bashio::config "icloud_directory_name")
 DELETE_LOCAL=$(bashio::config "delete_local_backups_after_upload")
+UPLOAD_CONCURRENCY=$(bashio::config "upload_concurrency" "3")
+FILESYSTEM_POLLING=$(bashio::config "filesystem_polling" "false")
 
 bashio::log.info "iCloud Directory: ${DIRECTORY}"
 bashio::log.info "Delete after upload: ${DELETE_LOCAL}"
+bashio::log.info "Upload concurrency: ${UPLOAD_CONCURRENCY}"
+bashio::log.info "Filesystem polling: ${FILESYSTEM_POLLING}"
 
 # Start application
 cd /app
-exec python3 uploader.py "${USERNAME}" "${PASSWORD}" "${DIRECTORY}" "${DELETE_LOCAL}"
+exec python3 uploader.py "${USERNAME}" "${PASSWORD}" "${DIRECTORY}" "${DELETE_LOCAL}" "${UPLOAD_CONCURRENCY}" "${FILESYSTEM_POLLING}"
@@ -5,59 +5,134 @@ iCloud Backup App Uploader
 
 import asyncio
 import os
+import random
+import re
+import sqlite3
 import sys
 import time
-from datetime import datetime
+from collections import OrderedDict
+from dataclasses import dataclass, field
 from pathlib import Path
-from typing import List, Optional, Set, Tuple
-from watchdog.observers import Observer
-from watchdog.events import FileSystemEventHandler, FileSystemEvent
+from typing import Callable, Dict, List, NamedTuple, Optional, Set, Tuple
+from watchdog.observers.api import BaseObserver
+from watchdog.observers.polling import PollingObserver
+from watchdog.events import (
+    FileClosedEvent,
+    FileMovedEvent,
+    FileSystemEventHandler,
+    FileSystemEvent
+)
 
 import aiohttp
 from aiohttp import web
 from pyicloud import PyiCloudService
+import requests
+from requests.adapters import HTTPAdapter
+from requests.cookies import get_cookie_header
 
 # Constants
 BACKUP_DIR = Path("/backup")
 COOKIE_PATH = Path("/data/pyicloud/cookie")
+STATE_DB_PATH = Path("/data/pyicloud/state.db")
 FRONTEND_DIR = Path("/app/frontend")
 WEB_PORT = 5000
 RETRY_DELAY = 60
+RETRY_BASE_DELAY = 30
+RETRY_MAX_DELAY = 900
+RETRY_JITTER = 2.0
+MAX_UPLOAD_RETRIES = 5
+VERIFICATION_CODE_TIMEOUT = 300
 FOLDER_CREATION_DELAY = 5
-FILE_WRITE_DELAY = 5
 FILE_STABILITY_CHECK_DELAY = 2
 FALLBACK_CHECK_INTERVAL = 300
+MAX_KNOWN_BACKUPS = 10_000
+KNOWN_BACKUP_TTL = 7 * 24 * 3600
 MAX_FOLDER_RETRIES = 3
+UPLOAD_READ_TIMEOUT = 300
+UPLOAD_READ_BUFFER_SIZE = 1 << 20
 SUPERVISOR_API = "http://supervisor"
 SUPERVISOR_TOKEN = os.environ.get("SUPERVISOR_TOKEN", "")
+DEFAULT_UPLOAD_CONCURRENCY = 3
+MAX_UPLOAD_CONCURRENCY = 8
+BACKUP_SLUG_PATTERN = re.compile(r"(?<![0-9a-f])[0-9a-f]{8}(?![0-9a-f])")
 
 # Global variables
-verification_code: Optional[str] = None
-upload_queue: Optional[asyncio.Queue] = None
-processed_files: Set[str] = set()
-web_runner: Optional[web.AppRunner] = None
-requires_2fa: bool = False
-is_authenticated: bool = False
+# (second, formatted timestamp), rebound as a whole so threads never see a mismatched pair
+_log_timestamp: Tuple[int, str] = (0, "")
+state_db: Optional[sqlite3.Connection] = None
+http_session: Optional[aiohttp.ClientSession] = None
+upload_session: Optional[aiohttp.ClientSession] = None
+# Shared across reconnects so pyicloud keeps its pooled keep-alive connections
+icloud_https_adapter = HTTPAdapter(pool_connections=4, pool_maxsize=16, max_retries=0)
+
+
+class AuthStatus(NamedTuple):
+    """iCloud authentication status, replaced as a whole so readers never see a partial update."""
+    requires_2fa: bool = False
+    is_authenticated: bool = False
+
+
+@dataclass(slots=True)
+class UploaderState:
+    """State shared by the upload workers, the file watcher and the web handlers."""
+    queue: asyncio.Queue
+    code_event: asyncio.Event
+    api_lock: asyncio.Lock
+    processed: Set[str] = field(default_factory=set)
+    active: Set[str] = field(default_factory=set)
+    retry_attempts: Dict[str, int] = field(default_factory=dict)
+    icloud_listing: Dict[str, Set[str]] = field(default_factory=dict)
+    file_snapshots: Dict[str, Tuple[int, int]] = field(default_factory=dict)
+    api: Optional[PyiCloudService] = None
+    code: Optional[str] = None
+    auth: AuthStatus = AuthStatus()
+
+
+STATE_KEY = web.AppKey("state", UploaderState)
+FRONTEND_FILES_KEY = web.AppKey("frontend_files", frozenset)
 
 
 def log(message: str) -> None:
     """Log message with timestamp to stdout."""
-    timestamp = datetime.now().strftime("%c")
-    print(f"{timestamp}: {message}", flush=True)
+    global _log_timestamp
+    
+    # Only reformat the timestamp when the second rolls over
+    now = int(time.time())
+    cached = _log_timestamp
+    if cached[0] != now:
+        cached = (now, time.strftime("%c", time.localtime(now)))
+        _log_timestamp = cached
+    print(f"{cached[1]}: {message}")
 
 
-def parse_arguments() -> Tuple[str, str, str, bool]:
+def parse_upload_concurrency(value: str) -> int:
+    """Parse the upload concurrency option, falling back to the default if invalid."""
+    try:
+        concurrency = int(value)
+    except ValueError:
+        log(f"Invalid upload_concurrency '{value}', using {DEFAULT_UPLOAD_CONCURRENCY}")
+        return DEFAULT_UPLOAD_CONCURRENCY
+    
+    return min(max(concurrency, 1), MAX_UPLOAD_CONCURRENCY)
+
+
+def parse_arguments() -> Tuple[str, str, str, bool, int, bool]:
     """Parse and validate command line arguments."""
     if len(sys.argv) < 5:
         log("Error: Insufficient arguments provided")
-        log("Usage: python uploader.py <username> <password> <folder> <delete_after_upload>")
+        log(
+            "Usage: python uploader.py <username> <password> <folder> <delete_after_upload> "
+            "[upload_concurrency] [filesystem_polling]"
+        )
         sys.exit(1)
     
     return (
         sys.argv[1],
         sys.argv[2],
         sys.argv[3],
-        sys.argv[4].lower() == "true"
+        sys.argv[4].lower() == "true",
+        parse_upload_concurrency(sys.argv[5]) if len(sys.argv) > 5 else DEFAULT_UPLOAD_CONCURRENCY,
+        len(sys.argv) > 6 and sys.argv[6].lower() == "true"
     )
 
 
@@ -67,16 +142,21 @@ async def serve_index(request: web.Request) -> web.Response:
     return web.FileResponse(FRONTEND_DIR / 'index.html')
 
 
-async def serve_static_file(request: web.Request) -> web.Response:
-    """Serve static files with fallback to index.html."""
-    filename = request.match_info.get('filename', 'index.html')
-    file_path = FRONTEND_DIR / filename
-    
-    if file_path.is_file():
-        return web.FileResponse(file_path)
-    
-    # Fallback for SPA routing
-    return web.FileResponse(FRONTEND_DIR / 'index.html')
+def list_frontend_files() -> frozenset:
+    """Return frontend file paths relative to FRONTEND_DIR, as the static route matches them."""
+    if not FRONTEND_DIR.is_dir():
+        return frozenset()
+    return frozenset(p.relative_to(FRONTEND_DIR).as_posix() for p in FRONTEND_DIR.rglob('*') if p.is_file())
+
+
+@web.middleware
+async def spa_fallback_middleware(request: web.Request, handler) -> web.StreamResponse:
+    """Fall back to index.html for unknown frontend paths (SPA routing)."""
+    # Only the static route has a filename; the frontend files are fixed at startup
+    filename = request.match_info.get('filename')
+    if filename is not None and filename not in request.app[FRONTEND_FILES_KEY]:
+        return web.FileResponse(FRONTEND_DIR / 'index.html')
+    return await handler(request)
 
 
 async def health_check(request: web.Request) -> web.Response:
@@ -86,30 +166,31 @@ async def health_check(request: web.Request) -> web.Response:
 
 async def status_check(request: web.Request) -> web.Response:
     """Status endpoint for frontend - indicates if 2FA is needed."""
-    global requires_2fa, is_authenticated
+    auth = request.app[STATE_KEY].auth
     
     return web.json_response({
-        "requires_2fa": requires_2fa,
-        "is_authenticated": is_authenticated,
+        "requires_2fa": auth.requires_2fa,
+        "is_authenticated": auth.is_authenticated,
         "status": "running"
     })
 
 
 async def receive_code(request: web.Request) -> web.Response:
     """Receive 2FA verification code via POST request."""
-    global verification_code
+    state = request.app[STATE_KEY]
     
     try:
         # Support both form-data and JSON
         if request.content_type == 'application/x-www-form-urlencoded' or 'multipart/form-data' in (request.content_type or ''):
             data = await request.post()
-            verification_code = data.get('code')
+            state.code = data.get('code')
         else:
             data = await request.json()
-            verification_code = data.get('code')
+            state.code = data.get('code')
         
-        if verification_code:
-            log(f"Verification code received: {verification_code}")
+        if state.code:
+            log(f"Verification code received: {state.code}")
+            state.code_event.set()
             return web.json_response({"success": True, "response": "Code received"})
         
         return web.json_response({"success": False, "error": "No code provided"}, status=400)
@@ -119,18 +200,21 @@ async def receive_code(request: web.Request) -> web.Response:
         return web.json_response({"success": False, "error": str(e)}, status=400)
 
 
-async def start_web_server() -> web.AppRunner:
+async def start_web_server(state: UploaderState) -> web.AppRunner:
     """Start aiohttp web server for frontend and 2FA code reception."""
-    global web_runner
-    
-    app = web.Application()
+    app = web.Application(middlewares=[spa_fallback_middleware])
+    app[STATE_KEY] = state
+    app[FRONTEND_FILES_KEY] = list_frontend_files()
     app.router.add_get('/health', health_check)
     app.router.add_get('/status', status_check)
     app.router.add_post('/send_code', receive_code)
     app.router.add_get('/', serve_index)
-    app.router.add_get('/{filename:.*}', serve_static_file)
+    if app[FRONTEND_FILES_KEY]:
+        app.router.add_static('/', FRONTEND_DIR, follow_symlinks=False, show_index=False)
+    else:
+        log(f"Frontend directory {FRONTEND_DIR} is missing or empty, serving API only")
     
-    web_runner = web.AppRunner(app)
+    web_runner = web.AppRunner(app, access_log=None)
     await web_runner.setup()
     
     site = web.TCPSite(web_runner, '0.0.0.0', WEB_PORT)
@@ -144,28 +228,90 @@ async def start_web_server() -> web.AppRunner:
 def get_local_backups() -> List[str]:
     """Get list of backup tar files in the backup directory."""
     try:
-        return [f.name for f in BACKUP_DIR.iterdir() if f.is_file() and f.suffix == '.tar']
+        with os.scandir(BACKUP_DIR) as entries:
+            return [e.name for e in entries if e.name.endswith('.tar') and e.is_file(follow_symlinks=False)]
     except Exception as e:
         log(f"Error listing backups: {e}")
         return []
 
 
-async def verify_file_complete(filepath: Path) -> bool:
-    """Verify that a file is completely written by checking size stability."""
-    if not filepath.is_file():
-        return False
+def verify_file_complete(
+    filepath: Path,
+    trusted_closed: bool,
+    snapshots: Dict[str, Tuple[int, int]]
+) -> bool:
+    """Verify that a file is completely written.
+    
+    Files reported by an inotify close-write or rename event are complete by
+    definition. Otherwise the file counts as complete once its size and mtime
+    are unchanged since the previous check, recorded in snapshots.
+    """
+    if trusted_closed:
+        return True
     
     try:
-        initial_size = filepath.stat().st_size
-        await asyncio.sleep(FILE_STABILITY_CHECK_DELAY)
-        
-        if not filepath.is_file():
-            return False
-            
-        return filepath.stat().st_size == initial_size
+        stat = filepath.stat()
     except Exception as e:
         log(f"Error verifying file {filepath.name}: {e}")
+        snapshots.pop(filepath.name, None)
         return False
+    
+    snapshot = (stat.st_size, stat.st_mtime_ns)
+    if snapshots.get(filepath.name) == snapshot:
+        del snapshots[filepath.name]
+        return True
+    
+    snapshots[filepath.name] = snapshot
+    return False
+
+
+# Upload State
+def open_state_db() -> Optional[sqlite3.Connection]:
+    """Open the persistent record of uploaded backups."""
+    try:
+        conn = sqlite3.connect(str(STATE_DB_PATH), isolation_level=None)
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.execute('PRAGMA synchronous=NORMAL')
+        conn.execute(
+            'CREATE TABLE IF NOT EXISTS processed '
+            '(name TEXT PRIMARY KEY, size INTEGER, mtime REAL, uploaded_at REAL)'
+        )
+        return conn
+    except Exception as e:
+        log(f'Upload state database unavailable: {e}')
+        return None
+
+
+def is_recorded_upload(filepath: Path) -> bool:
+    """Check if this exact file (name, size and mtime) was already uploaded."""
+    if state_db is None:
+        return False
+    
+    try:
+        stat = filepath.stat()
+        row = state_db.execute(
+            'SELECT 1 FROM processed WHERE name=? AND size=? AND mtime=?',
+            (filepath.name, stat.st_size, stat.st_mtime)
+        ).fetchone()
+        return row is not None
+    except Exception as e:
+        log(f'Error reading upload state for {filepath.name}: {e}')
+        return False
+
+
+def record_upload(filepath: Path) -> None:
+    """Remember that a file has been uploaded."""
+    if state_db is None:
+        return
+    
+    try:
+        stat = filepath.stat()
+        state_db.execute(
+            'INSERT OR REPLACE INTO processed (name, size, mtime, uploaded_at) VALUES (?, ?, ?, ?)',
+            (filepath.name, stat.st_size, stat.st_mtime, time.time())
+        )
+    except Exception as e:
+        log(f'Error saving upload state for {filepath.name}: {e}')
 
 
 # iCloud Operations
@@ -173,56 +319,55 @@ def connect_to_icloud(username: str, password: str) -> Optional[PyiCloudService]
     """Establish connection to iCloud with credentials."""
     log('Connecting to iCloud...')
     try:
-        return PyiCloudService(username, password, str(COOKIE_PATH))
+        api = PyiCloudService(username, password, str(COOKIE_PATH))
+        api.session.mount("https://", icloud_https_adapter)
+        return api
     except Exception as e:
         log(f'iCloud connection error: {e}')
         return None
 
 
-def handle_2fa_authentication(api: PyiCloudService) -> bool:
+async def handle_2fa_authentication(state: UploaderState, api: PyiCloudService) -> bool:
     """Handle 2FA authentication process."""
-    global verification_code, requires_2fa, is_authenticated
-    
     log('Two-factor authentication required')
     log('Waiting for verification code via web UI...')
     
     # Set flag to indicate 2FA is needed
-    requires_2fa = True
-    is_authenticated = False
+    state.auth = AuthStatus(requires_2fa=True, is_authenticated=False)
     
     # Wait for code from web interface
-    timeout = 300  # 5 minutes timeout
-    elapsed = 0
-    while verification_code is None and elapsed < timeout:
-        time.sleep(1)
-        elapsed += 1
+    if state.code is None:
+        state.code_event.clear()
+        try:
+            await asyncio.wait_for(state.code_event.wait(), timeout=VERIFICATION_CODE_TIMEOUT)
+        except asyncio.TimeoutError:
+            pass
     
-    if verification_code is None:
+    if state.code is None:
         log('Timeout waiting for verification code')
-        requires_2fa = False
+        state.auth = state.auth._replace(requires_2fa=False)
         return False
     
     try:
-        if not api.validate_2fa_code(verification_code):
+        if not await asyncio.to_thread(api.validate_2fa_code, state.code):
             log('Invalid verification code')
-            verification_code = None
+            state.code = None
             return False
         
         if not api.is_trusted_session:
             log('Requesting trusted session...')
-            if not api.trust_session():
+            if not await asyncio.to_thread(api.trust_session):
                 log('Failed to establish trusted session')
         
         log('2FA authentication successful')
-        verification_code = None
-        requires_2fa = False
-        is_authenticated = True
+        state.code = None
+        state.auth = AuthStatus(requires_2fa=False, is_authenticated=True)
         return True
         
     except Exception as e:
         log(f'2FA authentication error: {e}')
-        verification_code = None
-        requires_2fa = False
+        state.code = None
+        state.auth = state.auth._replace(requires_2fa=False)
         return False
 
 
@@ -287,10 +432,11 @@ def ensure_icloud_folder_exists(
         return False, None
 
 
-def file_exists_in_icloud(api: PyiCloudService, folder_name: str, filename: str) -> bool:
-    """Check if a file already exists in iCloud Drive folder."""
+def list_icloud_folder(api: PyiCloudService, folder_name: str) -> Optional[Set[str]]:
+    """Get the names of all files in an iCloud Drive folder."""
     try:
         folder_contents = api.drive[folder_name].dir()
+        names: Set[str] = set()
 
         # folder_contents items can be dicts, objects or simple strings depending on pyicloud version
         for item in folder_contents:
@@ -312,18 +458,17 @@ def file_exists_in_icloud(api: PyiCloudService, folder_name: str, filename: str)
             elif isinstance(item, str):
                 name = item
 
-            if name == filename:
-                log(f'File already exists in iCloud: {filename}')
-                return True
+            if name:
+                names.add(name)
 
-        return False
+        return names
 
     except KeyError:
         log(f'Folder "{folder_name}" not found while checking file existence')
-        return False
+        return None
     except Exception as e:
         log(f'Error checking file existence in iCloud: {e}')
-        return False
+        return None
 
 
 def upload_backup_file(api: PyiCloudService, folder_name: str, backup_file: str) -> bool:
@@ -345,6 +490,104 @@ def upload_backup_file(api: PyiCloudService, folder_name: str, backup_file: str)
         return False
 
 
+def _request_icloud_upload_url(
+    api: PyiCloudService,
+    folder_name: str,
+    file_in
+) -> Optional[Tuple[str, str, str, str]]:
+    """Request an upload URL from iCloud Drive. Returns (folder_id, zone, document_id, url)."""
+    try:
+        folder_data = api.drive[folder_name].data
+        folder_id, zone = folder_data['docwsid'], folder_data['zone']
+        document_id, content_url = api.drive._get_upload_contentws_url(file_in, zone=zone)
+        return folder_id, zone, document_id, content_url
+    except Exception as e:
+        log(f'Streaming upload unavailable, falling back to pyicloud upload: {e}')
+        return None
+
+
+async def get_upload_session() -> aiohttp.ClientSession:
+    """Get the shared iCloud upload session, creating it on first use."""
+    global upload_session
+    
+    if upload_session is None or upload_session.closed:
+        upload_session = aiohttp.ClientSession(
+            connector=aiohttp.TCPConnector(keepalive_timeout=75, enable_cleanup_closed=True),
+            timeout=aiohttp.ClientTimeout(total=None, sock_read=UPLOAD_READ_TIMEOUT),
+            # Cookies come from the pyicloud session on each request
+            cookie_jar=aiohttp.DummyCookieJar()
+        )
+    return upload_session
+
+
+async def async_upload_backup_file(
+    session: aiohttp.ClientSession,
+    api: PyiCloudService,
+    api_lock: asyncio.Lock,
+    folder_name: str,
+    backup_file: str
+) -> bool:
+    """Stream a single backup file to iCloud Drive, falling back to the pyicloud upload.
+    
+    pyicloud persists its session and cookies after every request, so all calls
+    through it are serialized on api_lock. Only the aiohttp stream runs unlocked.
+    """
+    backup_path = BACKUP_DIR / backup_file
+    
+    if not backup_path.is_file():
+        log(f'File not found: {backup_file}')
+        return False
+    
+    try:
+        # A 1 MiB read buffer turns aiohttp's 64 KiB payload reads into one read(2) per MiB
+        with open(backup_path, 'rb', buffering=UPLOAD_READ_BUFFER_SIZE) as file_in:
+            async with api_lock:
+                upload_target = await asyncio.to_thread(_request_icloud_upload_url, api, folder_name, file_in)
+                if upload_target is not None:
+                    folder_id, zone, document_id, content_url = upload_target
+                    
+                    # Snapshot the headers pyicloud would send, with only the cookies matching the upload host
+                    headers = {
+                        key: value for key, value in api.session.headers.items()
+                        if key.lower() not in ('content-type', 'content-length', 'cookie')
+                    }
+                    cookie_header = get_cookie_header(
+                        api.session.cookies,
+                        requests.Request('POST', content_url)
+                    )
+                    if cookie_header:
+                        headers['Cookie'] = cookie_header
+            
+            if upload_target is not None:
+                log(f'Uploading: {backup_file}')
+                
+                # Mirror the multipart layout pyicloud would send
+                form = aiohttp.FormData()
+                form.add_field(file_in.name, file_in, filename=backup_file, content_type='application/octet-stream')
+                
+                async with session.post(content_url, data=form, headers=headers) as response:
+                    response.raise_for_status()
+                    content_response = (await response.json(content_type=None))['singleFile']
+                
+                async with api_lock:
+                    await asyncio.to_thread(
+                        api.drive._update_contentws,
+                        folder_id,
+                        content_response,
+                        document_id,
+                        file_in,
+                        zone
+                    )
+                log(f'Successfully uploaded: {backup_file}')
+                return True
+    except Exception as e:
+        log(f'Upload failed for {backup_file}: {e}')
+        return False
+    
+    async with api_lock:
+        return await asyncio.to_thread(upload_backup_file, api, folder_name, backup_file)
+
+
 def cleanup_local_files(files_to_delete: List[str]) -> None:
     """Delete local backup files after successful upload."""
     for backup_name in files_to_delete:
@@ -360,42 +603,87 @@ def cleanup_local_files(files_to_delete: List[str]) -> None:
 class BackupFileHandler(FileSystemEventHandler):
     """Handles file system events for backup directory."""
     
-    def __init__(self, queue: asyncio.Queue, loop: asyncio.AbstractEventLoop):
+    def __init__(self, queue: asyncio.Queue, loop: asyncio.AbstractEventLoop, close_events: bool):
         super().__init__()
         self.queue = queue
         self.loop = loop
+        self.close_events = close_events
+    
+    def _queue_backup(self, path: str, trusted_closed: bool) -> None:
+        """Queue a backup file for upload."""
+        if not path.endswith('.tar'):
+            return
+        
+        filename = Path(path).name
+        log(f'Backup file detected: {filename}')
+        
+        # The queue is unbounded, so put_nowait cannot raise QueueFull
+        self.loop.call_soon_threadsafe(self.queue.put_nowait, (filename, trusted_closed))
         
     def on_created(self, event: FileSystemEvent) -> None:
-        """Called when a file is created."""
-        if event.is_directory or not event.src_path.endswith('.tar'):
+        """Called when a file is created (only used without close events)."""
+        if event.is_directory or self.close_events:
             return
         
-        filename = Path(event.src_path).name
-        log(f'Backup file detected: {filename}')
+        self._queue_backup(event.src_path, False)
+    
+    def on_closed(self, event: FileSystemEvent) -> None:
+        """Called when a file opened for writing is closed."""
+        if event.is_directory:
+            return
         
-        asyncio.run_coroutine_threadsafe(
-            self.queue.put(filename),
-            self.loop
-        )
+        self._queue_backup(event.src_path, True)
+    
+    def on_moved(self, event: FileSystemEvent) -> None:
+        """Called when a file is moved into the backup directory (including from unwatched ones)."""
+        if event.is_directory:
+            return
+        
+        self._queue_backup(event.dest_path, self.close_events)
+
+
+def create_observer(polling: bool) -> Tuple[BaseObserver, bool]:
+    """Create the filesystem observer. Returns (observer, close_events_supported)."""
+    if not polling:
+        try:
+            from watchdog.observers.inotify import InotifyObserver
+            # Full events report renames from unwatched directories as moves, not creations
+            return InotifyObserver(generate_full_events=True), True
+        except Exception as e:
+            log(f'inotify unavailable, falling back to polling: {e}')
+    
+    return PollingObserver(), False
 
 
 # Home Assistant API Integration
+async def get_http_session() -> aiohttp.ClientSession:
+    """Get the shared Supervisor API session, creating it on first use."""
+    global http_session
+    
+    if http_session is None or http_session.closed:
+        http_session = aiohttp.ClientSession(
+            connector=aiohttp.TCPConnector(
+                limit=32,
+                limit_per_host=4,
+                keepalive_timeout=75,
+                enable_cleanup_closed=True
+            ),
+            timeout=aiohttp.ClientTimeout(total=10),
+            headers={
+                "Authorization": f"Bearer {SUPERVISOR_TOKEN}",
+                "Content-Type": "application/json"
+            }
+        )
+    return http_session
+
+
 async def check_ha_backups(session: aiohttp.ClientSession) -> List[dict]:
     """Fetch backup list from Home Assistant Supervisor API."""
     if not SUPERVISOR_TOKEN:
         return []
     
     try:
-        headers = {
-            "Authorization": f"Bearer {SUPERVISOR_TOKEN}",
-            "Content-Type": "application/json"
-        }
-        
-        async with session.get(
-            f"{SUPERVISOR_API}/backups",
-            headers=headers,
-            timeout=aiohttp.ClientTimeout(total=10)
-        ) as response:
+        async with session.get(f"{SUPERVISOR_API}/backups") as response:
             if response.status == 200:
                 data = await response.json()
                 return data.get('data', {}).get('backups', [])
@@ -411,34 +699,69 @@ async def check_ha_backups(session: aiohttp.ClientSession) -> List[dict]:
     return []
 
 
+def map_backups_by_slug(backups: List[str]) -> Dict[str, str]:
+    """Map each slug-like token in the backup filenames to its file."""
+    by_slug: Dict[str, str] = {}
+    for filename in backups:
+        for slug in BACKUP_SLUG_PATTERN.findall(filename):
+            by_slug.setdefault(slug, filename)
+    return by_slug
+
+
 async def monitor_ha_api(queue: asyncio.Queue, interval: int) -> None:
     """Monitor Home Assistant API for new backups."""
     log('Starting HA API monitoring')
-    known_backups: Set[str] = set()
+    # Slug -> last time HA reported it, oldest first
+    known_backups: OrderedDict[str, float] = OrderedDict()
     
-    async with aiohttp.ClientSession() as session:
-        while True:
-            try:
-                backups = await check_ha_backups(session)
+    session = await get_http_session()
+    
+    while True:
+        try:
+            backups = await check_ha_backups(session)
+            local_backups: Optional[List[str]] = None
+            by_slug: Dict[str, str] = {}
+            
+            now = time.monotonic()
+            
+            for backup in backups:
+                slug = backup.get('slug')
+                if not isinstance(slug, str) or not slug:
+                    continue
+                slug = sys.intern(slug)
                 
-                for backup in backups:
-                    slug = backup.get('slug', '')
+                if slug in known_backups:
+                    known_backups[slug] = now
+                    known_backups.move_to_end(slug)
+                else:
+                    known_backups[slug] = now
                     
-                    if slug and slug not in known_backups:
-                        known_backups.add(slug)
-                        
-                        # Find corresponding tar file
-                        matching_files = [f for f in get_local_backups() if slug in f]
-                        
-                        if matching_files:
-                            log(f'New backup detected: {matching_files[0]}')
-                            await queue.put(matching_files[0])
-                
-                await asyncio.sleep(interval)
-                
-            except Exception as e:
-                log(f'HA API monitoring error: {e}')
-                await asyncio.sleep(RETRY_DELAY)
+                    # Scan the local backups once per poll, only when there is something new
+                    if local_backups is None:
+                        local_backups = get_local_backups()
+                        by_slug = map_backups_by_slug(local_backups)
+                    
+                    # Find corresponding tar file
+                    matching_file = by_slug.get(slug)
+                    if matching_file is None and not BACKUP_SLUG_PATTERN.fullmatch(slug):
+                        matching_file = next((f for f in local_backups if slug in f), None)
+                    
+                    if matching_file:
+                        log(f'New backup detected: {matching_file}')
+                        await queue.put((matching_file, False))
+            
+            # Forget slugs HA stopped reporting and cap the set size
+            while known_backups and (
+                len(known_backups) > MAX_KNOWN_BACKUPS
+                or next(iter(known_backups.values())) < now - KNOWN_BACKUP_TTL
+            ):
+                known_backups.popitem(last=False)
+            
+            await asyncio.sleep(interval)
+            
+        except Exception as e:
+            log(f'HA API monitoring error: {e}')
+            await asyncio.sleep(RETRY_DELAY)
 
 
 # Upload Worker
@@ -455,10 +778,10 @@ async def _ensure_connected(
     return api, None
 
 
-async def _ensure_authenticated(api: PyiCloudService) -> Tuple[bool, Optional[str]]:
+async def _ensure_authenticated(state: UploaderState, api: PyiCloudService) -> Tuple[bool, Optional[str]]:
     """Ensure iCloud session is authenticated. Returns (ok, error_message)."""
     if api.requires_2fa:
-        if not await asyncio.to_thread(handle_2fa_authentication, api):
+        if not await handle_2fa_authentication(state, api):
             return False, '2FA failed, retrying...'
         return True, None
 
@@ -467,8 +790,7 @@ async def _ensure_authenticated(api: PyiCloudService) -> Tuple[bool, Optional[st
         sys.exit(1)
 
     # No 2FA required, mark as authenticated
-    global is_authenticated
-    is_authenticated = True
+    state.auth = AuthStatus(requires_2fa=False, is_authenticated=True)
     return True, None
 
 
@@ -491,140 +813,231 @@ async def _ensure_folder(
     return refreshed_api, None
 
 
-async def _process_backup_file(
-    api: Optional[PyiCloudService],
-    filename: str,
-    username: str,
-    password: str,
-    folder_name: str,
-    delete_after_upload: bool
-) -> Tuple[Optional[PyiCloudService], bool, int, Optional[str]]:
-    """Process a single backup file. Returns (api, requeue, delay, message)."""
-    # Skip if already processed
-    if filename in processed_files:
-        return api, False, 0, None
+async def _get_icloud_listing(state: UploaderState, api: PyiCloudService, folder_name: str) -> Set[str]:
+    """Get the cached iCloud folder listing, fetching it on first use."""
+    async with state.api_lock:
+        listing = state.icloud_listing.get(folder_name)
+        if listing is None:
+            listing = await asyncio.to_thread(list_icloud_folder, api, folder_name)
+            if listing is None:
+                return set()
+            state.icloud_listing[folder_name] = listing
+        return listing
 
-    # Wait for file to be fully written
-    await asyncio.sleep(FILE_WRITE_DELAY)
 
-    # Verify file exists and is complete
-    filepath = BACKUP_DIR / filename
-    if not await verify_file_complete(filepath):
-        return api, True, 0, f'File incomplete or missing: {filename}, re-queuing'
+def _next_retry_delay(state: UploaderState, filename: str) -> Optional[float]:
+    """Get the backoff delay for the next retry of a file, or None once retries are exhausted."""
+    attempts = state.retry_attempts.get(filename, 0)
+    if attempts >= MAX_UPLOAD_RETRIES:
+        state.retry_attempts.pop(filename, None)
+        return None
 
-    log(f'Processing: {filename}')
+    state.retry_attempts[filename] = attempts + 1
+    return min(RETRY_MAX_DELAY, RETRY_BASE_DELAY * 2 ** attempts) + random.uniform(0, RETRY_JITTER)
 
-    # Ensure connection
-    api, connection_error = await _ensure_connected(api, username, password)
-    if api is None:
-        return None, True, RETRY_DELAY, connection_error
 
-    # Ensure authentication
-    auth_ok, auth_error = await _ensure_authenticated(api)
-    if not auth_ok:
-        return api, True, RETRY_DELAY, auth_error
+def _schedule_retry(
+    state: UploaderState,
+    filename: str,
+    message: Optional[str]
+) -> Tuple[bool, float, Optional[str]]:
+    """Build the (requeue, delay, message) result for a failed attempt."""
+    delay = _next_retry_delay(state, filename)
+    if delay is None:
+        return False, 0, f'Giving up on {filename} after {MAX_UPLOAD_RETRIES} retries: {message}'
+    return True, delay, f'{message} (next attempt in {delay:.0f}s)'
 
-    # Ensure folder exists (refresh API if folder created)
-    api, folder_error = await _ensure_folder(api, folder_name, username, password)
-    if folder_error:
-        return api, True, RETRY_DELAY, folder_error
 
-    # Check if file already exists in iCloud
-    if await asyncio.to_thread(file_exists_in_icloud, api, folder_name, filename):
-        log(f'Skipping upload - file already exists in iCloud: {filename}')
-        processed_files.add(filename)
-        return api, False, 0, None
+async def _process_backup_file(
+    state: UploaderState,
+    filename: str,
+    trusted_closed: bool,
+    username: str,
+    password: str,
+    folder_name: str,
+    delete_after_upload: bool
+) -> Tuple[bool, float, Optional[str]]:
+    """Process a single backup file. Returns (requeue, delay, message)."""
+    # Skip if already processed or being handled by another worker
+    if filename in state.processed or filename in state.active:
+        return False, 0, None
 
-    # Upload file
-    if await asyncio.to_thread(upload_backup_file, api, folder_name, filename):
-        processed_files.add(filename)
+    state.active.add(filename)
+    try:
+        # Verify file exists and is complete
+        filepath = BACKUP_DIR / filename
+        if not filepath.is_file():
+            state.file_snapshots.pop(filename, None)
+            return False, 0, f'File missing: {filename}, skipping'
+        first_check = filename not in state.file_snapshots
+        if not verify_file_complete(filepath, trusted_closed, state.file_snapshots):
+            message = f'Waiting for {filename} to stop changing, re-queuing' if first_check else None
+            return True, FILE_STABILITY_CHECK_DELAY, message
+        state.file_snapshots.pop(filename, None)
+
+        # Skip files uploaded before a restart without asking iCloud
+        if is_recorded_upload(filepath):
+            state.processed.add(filename)
+            return False, 0, f'Skipping upload - already uploaded: {filename}'
+
+        log(f'Processing: {filename}')
+
+        # Connection, authentication and folder setup share one API across workers
+        async with state.api_lock:
+            # Ensure connection
+            state.api, connection_error = await _ensure_connected(state.api, username, password)
+            if state.api is None:
+                state.icloud_listing.clear()
+                return _schedule_retry(state, filename, connection_error)
+
+            # Ensure authentication; waiting on the user does not use up the retry budget
+            auth_ok, auth_error = await _ensure_authenticated(state, state.api)
+            if not auth_ok:
+                state.icloud_listing.clear()
+                return True, RETRY_DELAY, f'{auth_error} (next attempt in {RETRY_DELAY}s)'
+
+            # Ensure folder exists (refresh API if folder created)
+            state.api, folder_error = await _ensure_folder(state.api, folder_name, username, password)
+            if folder_error:
+                state.icloud_listing.clear()
+                return _schedule_retry(state, filename, folder_error)
+
+            api = state.api
+
+        # Check if file already exists in iCloud
+        if filename in await _get_icloud_listing(state, api, folder_name):
+            log(f'Skipping upload - file already exists in iCloud: {filename}')
+            record_upload(filepath)
+            state.processed.add(filename)
+            state.retry_attempts.pop(filename, None)
+            return False, 0, None
+
+        # Upload file
+        session = await get_upload_session()
+        uploaded = await async_upload_backup_file(session, api, state.api_lock, folder_name, filename)
+
+        if not uploaded:
+            state.icloud_listing.pop(folder_name, None)
+            return _schedule_retry(state, filename, f'Upload failed: {filename}')
+
+        state.icloud_listing.get(folder_name, set()).add(filename)
+        record_upload(filepath)
+        state.processed.add(filename)
+        state.retry_attempts.pop(filename, None)
 
         # Delete local file if configured
         if delete_after_upload:
             await asyncio.to_thread(cleanup_local_files, [filename])
         log(f'Completed: {filename}')
-    else:
-        log(f'Upload failed: {filename}')
 
-    return api, False, 0, None
+        return False, 0, None
+    finally:
+        state.active.discard(filename)
 
 
 async def upload_worker(
+    state: UploaderState,
     username: str,
     password: str,
     folder_name: str,
     delete_after_upload: bool
 ) -> None:
     """Process upload queue and handle iCloud uploads."""
-    api: Optional[PyiCloudService] = None
+    queue = state.queue
+    loop = asyncio.get_running_loop()
     log('Upload worker started')
     
     while True:
-        filename = await upload_queue.get()
+        filename, trusted_closed = await queue.get()
 
         try:
-            api, requeue, delay, message = await _process_backup_file(
-                api,
+            requeue, delay, message = await _process_backup_file(
+                state,
                 filename,
+                trusted_closed,
                 username,
                 password,
                 folder_name,
                 delete_after_upload
             )
 
+            if message:
+                log(message)
             if requeue:
-                if message:
-                    log(message)
-                await asyncio.sleep(delay)
-                await upload_queue.put(filename)
+                # Requeue later without holding this worker through the backoff
+                loop.call_later(delay, queue.put_nowait, (filename, trusted_closed))
 
         except Exception as e:
             log(f'Upload worker error: {e}')
-            await asyncio.sleep(RETRY_DELAY)
-            await upload_queue.put(filename)
+            delay = _next_retry_delay(state, filename)
+            if delay is None:
+                log(f'Giving up on {filename} after {MAX_UPLOAD_RETRIES} retries')
+            else:
+                loop.call_later(delay, queue.put_nowait, (filename, trusted_closed))
         finally:
-            upload_queue.task_done()
+            queue.task_done()
 
 
 # Main Application
 async def main_async() -> None:
     """Main async execution function."""
-    global upload_queue
-    
-    # Start web server early to make health check available ASAP
-    await start_web_server()
+    global state_db
     
     # Parse arguments
-    username, password, folder_name, delete_after_upload = parse_arguments()
+    (
+        username,
+        password,
+        folder_name,
+        delete_after_upload,
+        upload_concurrency,
+        filesystem_polling
+    ) = parse_arguments()
+    
+    # Create shared state before the web server can receive codes
+    state = UploaderState(
+        queue=asyncio.Queue(),
+        code_event=asyncio.Event(),
+        api_lock=asyncio.Lock()
+    )
+    
+    # Start web server early to make health check available ASAP
+    web_runner = await start_web_server(state)
     
     log("=" * 50)
     log("iCloud Backup Uploader")
     log("=" * 50)
     log(f"iCloud folder: {folder_name}")
     log(f"Delete after upload: {delete_after_upload}")
+    log(f"Upload concurrency: {upload_concurrency}")
+    log(f"Filesystem polling: {filesystem_polling}")
     log("=" * 50)
     
-    # Initialize upload queue
-    upload_queue = asyncio.Queue()
+    # Open persistent upload state
+    state_db = open_state_db()
     
-    # Start upload worker
-    upload_task = asyncio.create_task(
-        upload_worker(username, password, folder_name, delete_after_upload)
-    )
+    # Start upload workers
+    upload_tasks = [
+        asyncio.create_task(
+            upload_worker(state, username, password, folder_name, delete_after_upload)
+        )
+        for _ in range(upload_concurrency)
+    ]
     
     # Start filesystem monitoring
     event_loop = asyncio.get_running_loop()
-    event_handler = BackupFileHandler(upload_queue, event_loop)
-    observer = Observer()
-    observer.schedule(event_handler, str(BACKUP_DIR), recursive=False)
+    observer, close_events = create_observer(filesystem_polling)
+    event_handler = BackupFileHandler(state.queue, event_loop, close_events)
+    # With inotify, only watch for closed writes and renames into the directory
+    event_filter = [FileClosedEvent, FileMovedEvent] if close_events else None
+    observer.schedule(event_handler, str(BACKUP_DIR), recursive=False, event_filter=event_filter)
     observer.start()
-    log(f'Filesystem monitoring active on {BACKUP_DIR}')
+    log(f'Filesystem monitoring active on {BACKUP_DIR} ({type(observer).__name__})')
     
     # Start HA API monitoring if available
     api_task = None
     if SUPERVISOR_TOKEN:
         api_task = asyncio.create_task(
-            monitor_ha_api(upload_queue, FALLBACK_CHECK_INTERVAL)
+            monitor_ha_api(state.queue, FALLBACK_CHECK_INTERVAL)
         )
     
     # Queue existing backups
@@ -632,11 +1045,11 @@ async def main_async() -> None:
     if existing:
         log(f'Found {len(existing)} existing backup(s)')
         for backup in existing:
-            await upload_queue.put(backup)
+            await state.queue.put((backup, False))
     
     # Run until interrupted
     try:
-        tasks = [upload_task]
+        tasks = list(upload_tasks)
         if api_task:
             tasks.append(api_task)
         
@@ -659,15 +1072,38 @@ async def main_async() -> None:
         observer.stop()
         observer.join()
         
-        if web_runner:
-            await web_runner.cleanup()
-            log("Web server stopped")
+        await web_runner.cleanup()
+        log("Web server stopped")
+        
+        if http_session and not http_session.closed:
+            await http_session.close()
+        
+        if upload_session and not upload_session.closed:
+            await upload_session.close()
+        
+        if state_db:
+            state_db.close()
+
+
+def get_loop_factory() -> Optional[Callable[[], asyncio.AbstractEventLoop]]:
+    """Get the uvloop event loop factory, or None to use the default loop."""
+    if sys.platform == "win32":
+        return None
+    
+    try:
+        import uvloop
+    except ImportError:
+        return None
+    
+    return uvloop.new_event_loop
 
 
 def main() -> None:
     """Main entry point."""
+    # Flush once per log line instead of per print call
+    sys.stdout.reconfigure(line_buffering=True, write_through=False)
     try:
-        asyncio.run(main_async())
+        asyncio.run(main_async(), loop_factory=get_loop_factory())
     except KeyboardInterrupt:
         log("Interrupted")
         sys.exit(0)